@@ -0,0 +1,314 @@
+"""
+admission_control.py — Token-Bucket Rate Limiting + Per-Stage Concurrency Caps + Deadlines
+
+Used by main.py to keep /process responsive under surge load:
+    request → token bucket (per API key / client IP) → 429 if empty
+            → deadline from X-Deadline-Ms header (unbounded without it, unless a default is configured)
+            → each pipeline stage waits for a slot → 503 if the wait would miss the deadline
+
+Shed requests fail fast with a Retry-After header instead of queueing behind OCR/Gemini.
+
+Run directly for a load test (stages stubbed to a fixed service time):
+    python admission_control.py
+"""
+
+import os
+import math
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# -----------------------------
+# CONFIG (override via .env)
+# -----------------------------
+RATE_PER_SEC = float(os.getenv("ADMISSION_RATE_PER_SEC", "2"))    # refill rate per client
+BURST = float(os.getenv("ADMISSION_BURST", "5"))                   # bucket size per client
+# Deadline for requests without X-Deadline-Ms; empty means no deadline (queue-full shedding still applies)
+DEFAULT_DEADLINE_S = float(os.getenv("ADMISSION_DEFAULT_DEADLINE_S") or "inf")
+MAX_DEADLINE_S = float(os.getenv("ADMISSION_MAX_DEADLINE_S", "300"))
+DEADLINE_HEADER = "X-Deadline-Ms"
+API_KEY_HEADER = "X-API-Key"
+# Comma-separated API keys that get their own bucket; any other (or missing) key is limited by client IP
+API_KEYS = [k.strip() for k in os.getenv("ADMISSION_API_KEYS", "").split(",") if k.strip()]
+
+# Concurrency cap and max waiting requests for each pipeline stage
+STAGE_LIMITS = {
+    "parser": int(os.getenv("ADMISSION_PARSER_CONCURRENCY", "4")),
+    "rider": int(os.getenv("ADMISSION_RIDER_CONCURRENCY", "8")),
+    "gemini": int(os.getenv("ADMISSION_GEMINI_CONCURRENCY", "4")),
+}
+STAGE_MAX_QUEUE = int(os.getenv("ADMISSION_STAGE_MAX_QUEUE", "16"))
+
+# Idle buckets are dropped after this many seconds; the least recently used go first past MAX_BUCKETS
+BUCKET_IDLE_TTL_S = 600
+MAX_BUCKETS = int(os.getenv("ADMISSION_MAX_BUCKETS", "10000"))
+
+
+# -----------------------------
+# ERRORS
+# -----------------------------
+class RequestShed(Exception):
+    """Raised when a request is rejected by admission control."""
+
+    def __init__(self, status_code: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def headers(self) -> dict:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+# -----------------------------
+# TOKEN BUCKET (per client)
+# -----------------------------
+class TokenBucketLimiter:
+    def __init__(self, rate: float = RATE_PER_SEC, burst: float = BURST, max_buckets: int = MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()   # key → (tokens, last_refill), least recently used first
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str) -> float:
+        """Take one token for `key`. Returns 0 on success, else seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / self.rate if self.rate > 0 else BUCKET_IDLE_TTL_S
+            self._buckets.move_to_end(key)
+            self._evict(now)
+        return wait
+
+    def _evict(self, now: float):
+        # Oldest entries sit at the front, so this only ever touches buckets it removes
+        while self._buckets:
+            _, last = next(iter(self._buckets.values()))
+            if len(self._buckets) <= self.max_buckets and now - last <= BUCKET_IDLE_TTL_S:
+                break
+            self._buckets.popitem(last=False)
+
+
+# -----------------------------
+# DEADLINES
+# -----------------------------
+def deadline_from_header(value):
+    """Convert the client's X-Deadline-Ms budget into an absolute time.monotonic() deadline (None = unbounded)."""
+    budget = DEFAULT_DEADLINE_S
+    if value:
+        try:
+            budget = min(float(value) / 1000.0, MAX_DEADLINE_S)
+        except ValueError:
+            pass
+    if math.isinf(budget):
+        return None
+    return time.monotonic() + max(0.0, budget)
+
+def remaining(deadline) -> float:
+    """Seconds left before `deadline` (None means no deadline)."""
+    if deadline is None:
+        return math.inf
+    return deadline - time.monotonic()
+
+
+# -----------------------------
+# PER-STAGE CONCURRENCY CAPS
+# -----------------------------
+class StageGate:
+    """Async semaphore with a bounded wait queue; requests that can't finish before their deadline are shed."""
+
+    def __init__(self, name: str, limit: int, max_queue: int = STAGE_MAX_QUEUE):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self._sem = None
+        self._waiting = 0
+        self._avg_service_s = None  # EWMA of stage run time, used for shedding and Retry-After hints
+        # Own worker threads so a stage's slots never wait on the shared default executor
+        self._pool = ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"stage-{name}")
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so it binds to the server's running event loop
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.limit)
+        return self._sem
+
+    def retry_after(self) -> float:
+        return (self._avg_service_s or 1.0) * (self._waiting + 1) / max(1, self.limit)
+
+    def expected_latency(self) -> float:
+        """Estimated queueing delay plus service time for a request arriving now."""
+        if self._avg_service_s is None:
+            return 0.0
+        busy = self._sem is not None and self._sem.locked()
+        return self._avg_service_s * ((self._waiting / self.limit + 1) if busy else 1)
+
+    async def run(self, deadline, func, *args, **kwargs):
+        """Run the blocking `func` in a worker thread once a slot frees up."""
+        sem = self._semaphore()
+        if sem.locked() and self._waiting >= self.max_queue:
+            raise RequestShed(503, f"{self.name} queue full", self.retry_after())
+
+        budget = remaining(deadline)
+        if budget <= 0:
+            raise RequestShed(503, f"deadline exceeded before {self.name}", self.retry_after())
+        if self.expected_latency() > budget:
+            # Fail fast instead of doing work the client will have given up on
+            raise RequestShed(503, f"{self.name} cannot finish before deadline", self.retry_after())
+
+        self._waiting += 1
+        try:
+            # Stop waiting once there's no longer time left to actually run the stage
+            timeout = None if math.isinf(budget) else max(0.0, budget - (self._avg_service_s or 0.0))
+            await asyncio.wait_for(sem.acquire(), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise RequestShed(503, f"deadline exceeded waiting for {self.name}", self.retry_after())
+        finally:
+            self._waiting -= 1
+
+        try:
+            started = time.monotonic()
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._pool, lambda: func(*args, **kwargs))
+            elapsed = time.monotonic() - started
+            self._avg_service_s = elapsed if self._avg_service_s is None else 0.8 * self._avg_service_s + 0.2 * elapsed
+            return result
+        finally:
+            sem.release()
+
+
+def build_stage_gates(limits: dict = None) -> dict:
+    return {name: StageGate(name, limit) for name, limit in (limits or STAGE_LIMITS).items()}
+
+
+def admit(gates: dict, deadline):
+    """Shed up front when the whole pipeline's expected latency already exceeds the deadline."""
+    budget = remaining(deadline)
+    expected = sum(gate.expected_latency() for gate in gates.values())
+    if expected > budget:
+        raise RequestShed(503, "pipeline cannot finish before deadline",
+                          max(gate.retry_after() for gate in gates.values()))
+
+
+def _key_digest(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+# Digests, so the lookup never compares secrets character by character
+API_KEY_DIGESTS = frozenset(_key_digest(k) for k in API_KEYS)
+
+def client_key(headers, client_host) -> str:
+    """Rate-limit key: a configured API key if the client sent one, otherwise its IP address."""
+    api_key = headers.get(API_KEY_HEADER)
+    if api_key:
+        digest = _key_digest(api_key)
+        if digest in API_KEY_DIGESTS:
+            return f"key:{digest[:16]}"
+    # Unknown keys are ignored, so rotating the header can't mint fresh buckets
+    return f"ip:{client_host or 'unknown'}"
+
+
+# -----------------------------
+# LOAD TEST
+# -----------------------------
+# Fixed service time per stubbed stage (seconds)
+LOAD_TEST_SERVICE_S = {"parser": 0.20, "rider": 0.05, "gemini": 0.30}
+LOAD_TEST_DEADLINE_MS = 2000
+LOAD_TEST_DURATION_S = 5.0
+LOAD_TEST_CLIENTS = 50
+
+def _pipeline_capacity() -> float:
+    """Requests/s the slowest stage can sustain with STAGE_LIMITS slots."""
+    return min(STAGE_LIMITS[name] / service for name, service in LOAD_TEST_SERVICE_S.items())
+
+async def _run_level(client, rps: float) -> dict:
+    counts = {"ok": 0, "late": 0, "429": 0, "503": 0, "other": 0}
+    last_done = [0.0]
+
+    async def one(i: int):
+        started = time.monotonic()
+        resp = await client.post(
+            "/process",
+            data={"patient_name": "Load Test", "age": "50", "sex": "M", "symptoms": "{}"},
+            headers={API_KEY_HEADER: f"client-{i % LOAD_TEST_CLIENTS}", DEADLINE_HEADER: str(LOAD_TEST_DEADLINE_MS)},
+        )
+        if resp.status_code == 200:
+            in_time = time.monotonic() - started <= LOAD_TEST_DEADLINE_MS / 1000
+            counts["ok" if in_time else "late"] += 1
+        else:
+            key = str(resp.status_code)
+            counts[key if key in counts else "other"] += 1
+        last_done[0] = max(last_done[0], time.monotonic())
+
+    # Open-loop arrivals: requests are fired on schedule regardless of completions
+    tasks, n = [], int(rps * LOAD_TEST_DURATION_S)
+    t0 = time.monotonic()
+    for i in range(n):
+        await asyncio.sleep(max(0.0, t0 + i / rps - time.monotonic()))
+        tasks.append(asyncio.create_task(one(i)))
+    await asyncio.gather(*tasks)
+    counts["sent"] = n
+    # First arrival → last completion, so requests still draining after the arrival window count against goodput
+    counts["elapsed_s"] = max(last_done[0], t0) - t0
+    counts["goodput_rps"] = counts["ok"] / counts["elapsed_s"] if counts["elapsed_s"] > 0 else 0.0
+    return counts
+
+def run_load_test(multipliers=(1, 2, 3, 5)):
+    import io
+    import contextlib
+    import httpx
+    import main
+    import admission_control as gates_module    # the copy main.py uses, even when this file runs as __main__
+
+    # Register the load test's API keys so each simulated client gets its own bucket
+    gates_module.API_KEY_DIGESTS = frozenset(
+        gates_module._key_digest(f"client-{i}") for i in range(LOAD_TEST_CLIENTS)
+    )
+
+    service = LOAD_TEST_SERVICE_S
+
+    def parser_stub(form_data, file_paths, output_path, deadline=None, file_names=None, instrument=None):
+        time.sleep(service["parser"])
+        return {"patient_name": form_data.get("patient_name")}
+
+    def rider_stub(input_path, output_path=None):
+        time.sleep(service["rider"])
+        return {}
+
+    def gemini_stub(input_path, output_path, deadline=None):
+        time.sleep(service["gemini"])
+        return {}
+
+    main.run_parser, main.run_rider, main.run_gemini = parser_stub, rider_stub, gemini_stub
+    capacity = _pipeline_capacity()
+
+    async def drive():
+        print(f"📊 Admission load test: capacity ≈ {capacity:.1f} req/s, deadline {LOAD_TEST_DEADLINE_MS} ms, "
+              f"{LOAD_TEST_DURATION_S:.0f} s per level, {LOAD_TEST_CLIENTS} API keys")
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+            for mult in multipliers:
+                # Fresh limiter and gates so levels don't inherit each other's queues
+                # (use main's imported classes — this file may be running as __main__)
+                main.rate_limiter = main.TokenBucketLimiter()
+                main.stage_gates = main.build_stage_gates()
+                with contextlib.redirect_stdout(io.StringIO()):     # silence per-request pipeline logs
+                    r = await _run_level(client, capacity * mult)
+                print(f"   {mult}× ({capacity * mult:5.1f} req/s): sent {r['sent']:4d}  "
+                      f"goodput {r['goodput_rps']:5.1f} req/s over {r['elapsed_s']:4.1f} s  ok {r['ok']:4d}  late {r['late']:3d}  "
+                      f"429 {r['429']:4d}  503 {r['503']:4d}  other {r['other']}")
+
+    asyncio.run(drive())
+
+
+if __name__ == "__main__":
+    run_load_test()
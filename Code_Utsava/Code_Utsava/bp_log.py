@@ -0,0 +1,358 @@
+"""
+bp_log.py — Home Blood-Pressure Log Import + Vectorized Statistics
+
+Accepts a log of timestamped readings as:
+    CSV   header row with timestamp / systolic / diastolic columns (aliases below);
+          separate date + time columns are combined when there is no timestamp column
+    JSON  a top-level array of objects, decoded incrementally
+    JSONL one object per line (.jsonl / .ndjson)
+
+Rows are streamed into compact arrays (never a list of dicts), then every statistic
+and the per-reading grading run as NumPy array operations. The summary's
+`effective_grade` is what rider.py uses as the patient's hypertension grade.
+
+Run directly for a 100k-reading benchmark:
+    python bp_log.py
+"""
+
+import io
+import os
+import re
+import csv
+import json
+import time
+import datetime
+from array import array
+import numpy as np
+
+# -----------------------------
+# CONFIG
+# -----------------------------
+FIELD_ALIASES = {
+    "timestamp": ("timestamp", "datetime", "date_time", "measured_at"),
+    "systolic": ("systolic", "sys", "bp_systolic", "systolic_bp", "sbp"),
+    "diastolic": ("diastolic", "dia", "bp_diastolic", "diastolic_bp", "dbp"),
+}
+# Used when there is no single timestamp column: date and/or time, joined as "<date> <time>"
+DATE_ALIASES = ("date", "day")
+TIME_ALIASES = ("time", "clock_time")
+# Same grade names and order of checks as classify_hypertension() in medical_json_parser.py
+GRADES = ("normal", "elevated", "stage_1", "stage_2", "resistant")
+MORNING_HOURS = (4, 12)     # [start, end) local clock hours
+EVENING_HOURS = (18, 24)
+PLAUSIBLE_SYSTOLIC = (60, 300)
+PLAUSIBLE_DIASTOLIC = (30, 200)
+JSON_CHUNK_SIZE = 1 << 16
+
+_JSON_SKIP = re.compile(r"[\s,]*")
+_ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_EPOCH = re.compile(r"\d{9,13}(?:\.\d+)?")      # Unix seconds, or milliseconds from 13 digits
+
+
+# -----------------------------
+# STREAMING READERS
+# -----------------------------
+def _find_column(lookup: dict, aliases):
+    return next((lookup[a] for a in aliases if a in lookup), None)
+
+def _resolve_columns(keys) -> dict:
+    """Map each field to its column; "timestamp" may be a (date, time) pair of columns."""
+    lookup = {str(k).strip().lower(): k for k in keys}
+    cols = {}
+    for field, aliases in FIELD_ALIASES.items():
+        col = _find_column(lookup, aliases)
+        if col is not None:
+            cols[field] = col
+    if "timestamp" not in cols:
+        date_col, time_col = _find_column(lookup, DATE_ALIASES), _find_column(lookup, TIME_ALIASES)
+        if date_col is not None and time_col is not None:
+            cols["timestamp"] = (date_col, time_col)
+        elif date_col is not None or time_col is not None:
+            cols["timestamp"] = date_col if date_col is not None else time_col
+    missing = [f for f in FIELD_ALIASES if f not in cols]
+    if missing:
+        raise ValueError(f"BP log is missing column(s): {', '.join(missing)}")
+    return cols
+
+def _iter_csv(stream):
+    reader = csv.reader(stream)
+    header = next(reader, None)
+    if not header:
+        return
+    cols = _resolve_columns(header)
+    sys_i, dia_i = header.index(cols["systolic"]), header.index(cols["diastolic"])
+    if isinstance(cols["timestamp"], tuple):
+        date_i, time_i = (header.index(name) for name in cols["timestamp"])
+        width = max(date_i, time_i, sys_i, dia_i)
+        for row in reader:
+            if len(row) > width:
+                yield f"{row[date_i].strip()} {row[time_i].strip()}", row[sys_i], row[dia_i]
+        return
+    ts_i = header.index(cols["timestamp"])
+    width = max(ts_i, sys_i, dia_i)
+    for row in reader:
+        if len(row) > width:
+            yield row[ts_i], row[sys_i], row[dia_i]
+
+def _iter_json_objects(stream):
+    """Yield elements of a top-level JSON array without reading the whole document."""
+    decoder = json.JSONDecoder()
+    buf = stream.read(JSON_CHUNK_SIZE).lstrip()
+    if not buf.startswith("["):
+        raise ValueError("JSON BP log must be an array of readings")
+    buf, pos = buf[1:], 0
+    while True:
+        pos = _JSON_SKIP.match(buf, pos).end()
+        if pos >= len(buf):
+            more = stream.read(JSON_CHUNK_SIZE)
+            if not more:
+                return
+            buf, pos = buf[pos:] + more, 0
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            obj, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Element spans the chunk boundary — pull in more text and retry
+            more = stream.read(JSON_CHUNK_SIZE)
+            if not more:
+                raise
+            buf, pos = buf[pos:] + more, 0
+            continue
+        yield obj
+        if pos > JSON_CHUNK_SIZE:
+            buf, pos = buf[pos:], 0
+
+def _iter_jsonl_objects(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def _iter_objects_as_rows(objects):
+    cols = None
+    for obj in objects:
+        if not isinstance(obj, dict):
+            continue
+        if cols is None:
+            cols = _resolve_columns(obj.keys())
+        if isinstance(cols["timestamp"], tuple):
+            date, clock = (obj.get(name) for name in cols["timestamp"])
+            ts = f"{str(date).strip()} {str(clock).strip()}" if date and clock else None
+        else:
+            ts = obj.get(cols["timestamp"])
+        yield ts, obj.get(cols["systolic"]), obj.get(cols["diastolic"])
+
+def detect_format(filename: str) -> str:
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext == ".csv":
+        return "csv"
+    if ext in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if ext == ".json":
+        return "json"
+    raise ValueError(f"Unsupported BP log type '{ext or filename}' (expected .csv, .json or .jsonl)")
+
+
+# -----------------------------
+# PARSE → ARRAYS
+# -----------------------------
+def _parse_timestamps(raw: list) -> np.ndarray:
+    """
+    ISO dates (vectorized when every row is ISO) or Unix epochs, taken as UTC;
+    anything else is NaT. numpy alone would read an epoch like "1709280000" as a year.
+    """
+    if all(_ISO_DATE.match(s) for s in raw):
+        try:
+            return np.array([s[:16] for s in raw], dtype="datetime64[m]")
+        except (ValueError, TypeError):
+            pass
+    out = np.empty(len(raw), dtype="datetime64[m]")
+    for i, s in enumerate(raw):
+        out[i] = np.datetime64("NaT")
+        s = str(s).strip()
+        if _EPOCH.fullmatch(s):
+            seconds = float(s) / (1000 if len(s.split(".")[0]) == 13 else 1)
+            out[i] = np.datetime64(int(seconds), "s").astype("datetime64[m]")
+            continue
+        if not _ISO_DATE.match(s):
+            continue
+        try:
+            # Keep the patient's local clock time so morning/evening stays meaningful
+            out[i] = np.datetime64(datetime.datetime.fromisoformat(s).replace(tzinfo=None), "m")
+            continue
+        except (ValueError, TypeError):
+            pass
+        for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"):    # e.g. date + "7:05" time columns
+            try:
+                out[i] = np.datetime64(datetime.datetime.strptime(s, fmt), "m")
+                break
+            except ValueError:
+                continue
+    return out
+
+def load_readings(stream, fmt: str) -> dict:
+    """Stream rows from a text stream into arrays of timestamps, systolic and diastolic values."""
+    if fmt == "csv":
+        rows = _iter_csv(stream)
+    elif fmt == "jsonl":
+        rows = _iter_objects_as_rows(_iter_jsonl_objects(stream))
+    else:
+        rows = _iter_objects_as_rows(_iter_json_objects(stream))
+
+    stamps, sys_bp, dia_bp = [], array("d"), array("d")
+    skipped = 0
+    for ts, s, d in rows:
+        try:
+            s, d = float(s), float(d)
+        except (TypeError, ValueError):
+            skipped += 1
+            continue
+        stamps.append(str(ts or "").strip())
+        sys_bp.append(s)
+        dia_bp.append(d)
+
+    sys_arr = np.frombuffer(sys_bp, dtype=np.float64)
+    dia_arr = np.frombuffer(dia_bp, dtype=np.float64)
+    valid = (
+        (sys_arr >= PLAUSIBLE_SYSTOLIC[0]) & (sys_arr <= PLAUSIBLE_SYSTOLIC[1])
+        & (dia_arr >= PLAUSIBLE_DIASTOLIC[0]) & (dia_arr <= PLAUSIBLE_DIASTOLIC[1])
+        & (sys_arr > dia_arr)
+    )
+    ts_arr = _parse_timestamps(stamps)
+    return {
+        "timestamps": ts_arr[valid],
+        "systolic": sys_arr[valid],
+        "diastolic": dia_arr[valid],
+        "skipped": skipped + int((~valid).sum()),
+    }
+
+
+# -----------------------------
+# VECTORIZED STATISTICS
+# -----------------------------
+def grade_readings(systolic: np.ndarray, diastolic: np.ndarray) -> np.ndarray:
+    """Index into GRADES for every reading (vectorized classify_hypertension)."""
+    s, d = systolic, diastolic
+    conditions = [
+        (s >= 180) | (d >= 120),
+        (s >= 140) | (d >= 90),
+        ((s >= 130) & (s < 140)) | ((d >= 80) & (d < 90)),
+        (s >= 120) & (s < 130) & (d < 80),
+    ]
+    return np.select(conditions, [4, 3, 2, 1], default=0)
+
+def _mean_pair(systolic, diastolic, mask) -> dict:
+    n = int(mask.sum())
+    if n == 0:
+        return {"count": 0, "systolic_mean": None, "diastolic_mean": None}
+    return {
+        "count": n,
+        "systolic_mean": round(float(systolic[mask].mean()), 1),
+        "diastolic_mean": round(float(diastolic[mask].mean()), 1),
+    }
+
+def _variability(values: np.ndarray, chronological: np.ndarray) -> dict:
+    sd = float(values.std(ddof=1)) if values.size > 1 else 0.0
+    mean = float(values.mean())
+    # Average real variability: mean absolute change between consecutive (dated) readings
+    arv = float(np.abs(np.diff(chronological)).mean()) if chronological.size > 1 else 0.0
+    return {
+        "sd": round(sd, 1),
+        "cv_percent": round(100 * sd / mean, 1) if mean else 0.0,
+        "arv": round(arv, 1),
+        "min": round(float(values.min()), 1),
+        "max": round(float(values.max()), 1),
+    }
+
+def summarize_readings(timestamps: np.ndarray, systolic: np.ndarray, diastolic: np.ndarray) -> dict:
+    n = systolic.size
+    if n == 0:
+        raise ValueError("BP log contains no valid readings")
+
+    # Chronological order for ARV; NaT timestamps sort last and are left out of ARV
+    order = np.argsort(timestamps, kind="stable")
+    ts, s, d = timestamps[order], systolic[order], diastolic[order]
+
+    dated = ~np.isnat(ts)
+    hours = np.full(n, -1, dtype=np.int64)
+    hours[dated] = (ts[dated] - ts[dated].astype("datetime64[D]")).astype("timedelta64[h]").astype(np.int64)
+    morning = (hours >= MORNING_HOURS[0]) & (hours < MORNING_HOURS[1])
+    evening = (hours >= EVENING_HOURS[0]) & (hours < EVENING_HOURS[1])
+
+    codes = grade_readings(s, d)
+    counts = np.bincount(codes, minlength=len(GRADES))
+
+    sys_mean, dia_mean = float(s.mean()), float(d.mean())
+    effective = GRADES[int(grade_readings(np.array([sys_mean]), np.array([dia_mean]))[0])]
+
+    morning_stats = _mean_pair(s, d, morning)
+    evening_stats = _mean_pair(s, d, evening)
+    surge = None
+    if morning_stats["count"] and evening_stats["count"]:
+        surge = round(morning_stats["systolic_mean"] - evening_stats["systolic_mean"], 1)
+
+    return {
+        "reading_count": int(n),
+        "undated_rows": int(n - dated.sum()),      # readings whose timestamp was missing or unparseable
+        "period_start": str(ts[dated][0]) if dated.any() else None,
+        "period_end": str(ts[dated][-1]) if dated.any() else None,
+        "systolic_mean": round(sys_mean, 1),
+        "diastolic_mean": round(dia_mean, 1),
+        "morning": morning_stats,
+        "evening": evening_stats,
+        "morning_evening_systolic_diff": surge,
+        "variability": {"systolic": _variability(s, s[dated]), "diastolic": _variability(d, d[dated])},
+        "grade_share": {g: round(float(c) / n, 4) for g, c in zip(GRADES, counts)},
+        "effective_grade": effective,
+    }
+
+
+# -----------------------------
+# ENTRY POINT (used by main.py)
+# -----------------------------
+def summarize_bp_log(fileobj, filename: str) -> dict:
+    """Parse a binary upload stream and return the home BP summary."""
+    fmt = detect_format(filename)
+    stream = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    try:
+        data = load_readings(stream, fmt)
+    finally:
+        stream.detach()     # leave the upload's file object open for its owner
+    summary = summarize_readings(data["timestamps"], data["systolic"], data["diastolic"])
+    summary["skipped_rows"] = data["skipped"]
+    summary["source_format"] = fmt
+    return summary
+
+
+# -----------------------------
+# BENCHMARK
+# -----------------------------
+def _synthetic_csv(n: int) -> bytes:
+    rng = np.random.default_rng(7)
+    start = np.datetime64("2024-01-01T06:00")
+    offsets = np.cumsum(rng.integers(120, 900, n)).astype("timedelta64[m]")
+    stamps = np.datetime_as_string(start + offsets, unit="m")
+    sys_bp = rng.normal(138, 14, n).round().astype(int)
+    dia_bp = (sys_bp * 0.62 + rng.normal(0, 6, n)).round().astype(int)
+    lines = ["timestamp,systolic,diastolic"]
+    lines += [f"{t},{s},{d}" for t, s, d in zip(stamps, sys_bp, dia_bp)]
+    return ("\n".join(lines) + "\n").encode()
+
+def run_benchmark(n: int = 100_000):
+    payload = _synthetic_csv(n)
+    as_json = json.dumps([
+        dict(zip(("timestamp", "systolic", "diastolic"), line.split(",")))
+        for line in payload.decode().splitlines()[1:]
+    ]).encode()
+    print(f"📊 BP log benchmark: {n:,} readings")
+    for name, data, fname in (("csv", payload, "log.csv"), ("json", as_json, "log.json")):
+        started = time.perf_counter()
+        summary = summarize_bp_log(io.BytesIO(data), fname)
+        elapsed = time.perf_counter() - started
+        print(f"   {name:<5} {len(data) / 1e6:5.1f} MB  {elapsed:5.3f} s  → {summary['effective_grade']}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -1,10 +1,11 @@
-from fastapi import FastAPI, UploadFile, Form, File
+from fastapi import FastAPI, UploadFile, Form, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import tempfile, os, json, uvicorn
+from fastapi.responses import JSONResponse, Response
+import tempfile, os, json, uvicorn, shutil
 from dotenv import load_dotenv
 import os 
 import traceback
+from typing import List
 
 # ------------------------------------------------------
 # FIX 1: Load Environment Variables from .env
@@ -18,6 +19,15 @@ load_dotenv()
 from medical_json_parser import process_inputs as run_parser
 from rider import generate_final_recommendation as run_rider
 from recommendation_gemini import generate_gemini_recommendation as run_gemini
+from bp_log import summarize_bp_log
+from admission_control import (
+    RequestShed, TokenBucketLimiter, build_stage_gates, admit,
+    client_key, deadline_from_header, DEADLINE_HEADER,
+)
+from request_profiler import (
+    ProfileSession, ProfileStore, is_admin,
+    PROFILE_HEADER, ADMIN_TOKEN_HEADER, PROFILE_MODES,
+)
 
 # ------------------------------------------------------
 # APP CONFIG
@@ -41,12 +51,48 @@ app.add_middleware(
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "health_ai_core", "data")
 
-COMBINED_JSON = os.path.join(DATA_DIR, "combined_output.json")
-RIDER_JSON = os.path.join(DATA_DIR, "final_combined_with_rider.json")
-FINAL_JSON = os.path.join(DATA_DIR, "final_output_with_gemini.json")
+# Intermediate JSON names; each request writes them into its own work dir under DATA_DIR
+COMBINED_JSON = "combined_output.json"
+RIDER_JSON = "final_combined_with_rider.json"
+FINAL_JSON = "final_output_with_gemini.json"
 
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# ------------------------------------------------------
+# ADMISSION CONTROL
+# ------------------------------------------------------
+rate_limiter = TokenBucketLimiter()
+stage_gates = build_stage_gates()
+ADMISSION_PATHS = ("/process", "/bp-log")
+
+def shed_response(shed: RequestShed) -> JSONResponse:
+    print(f"🚦 Shedding request ({shed.status_code}): {shed.reason}")
+    return JSONResponse(
+        content={"error": shed.reason},
+        status_code=shed.status_code,
+        headers=shed.headers()
+    )
+
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    """Rate-limit /process before the upload body is read, and stamp the request deadline."""
+    if request.url.path in ADMISSION_PATHS and request.method == "POST":
+        key = client_key(request.headers, request.client.host if request.client else None)
+        wait = rate_limiter.acquire(key)
+        if wait > 0:
+            return shed_response(RequestShed(429, "Rate limit exceeded", wait))
+        request.state.deadline = deadline_from_header(request.headers.get(DEADLINE_HEADER))
+    return await call_next(request)
+
+# ------------------------------------------------------
+# ON-DEMAND PROFILING (admin only)
+# ------------------------------------------------------
+profile_store = ProfileStore()
+
+def stage_func(session, stage, func):
+    """Instrument `func` only when this request asked to be profiled."""
+    return session.wrap(stage, func) if session else func
+
 # ------------------------------------------------------
 # ROUTES
 # ------------------------------------------------------
@@ -59,6 +105,7 @@ def root():
 
 @app.post("/process")
 async def process_pipeline(
+    request: Request,
     patient_name: str = Form(...),
     age: int = Form(...),
     sex: str = Form(...),
@@ -68,21 +115,52 @@ async def process_pipeline(
     temperature_c: float = Form(None),
     spo2_percent: int = Form(None),
     symptoms: str = Form("[]"),
-    pdf_file: UploadFile = File(None)
+    pdf_file: UploadFile = File(None),
+    files: List[UploadFile] = File(None)
 ):
     """
     Pipeline: 1. Form → Parser 2. Parser Output → Rider 3. Rider Output → Gemini
+    Each stage runs behind a concurrency cap; requests that would miss their deadline are shed.
+    Send any number of reports as `files` (the single `pdf_file` field is still accepted);
+    they are extracted concurrently and merged per patient.
     """
+    deadline = getattr(request.state, "deadline", None)
+
+    profile_mode = (request.headers.get(PROFILE_HEADER) or request.query_params.get("profile") or "").strip().lower()
+    if profile_mode:
+        if not is_admin(request.headers.get(ADMIN_TOKEN_HEADER)):
+            return JSONResponse(content={"error": "Profiling requires a valid admin token"}, status_code=403)
+        if profile_mode not in PROFILE_MODES:
+            return JSONResponse(
+                content={"error": f"Unknown profile mode '{profile_mode}', expected one of {PROFILE_MODES}"},
+                status_code=400
+            )
+
+    profile_session = None
+    work_dir = tempfile.mkdtemp(prefix="req_", dir=DATA_DIR)
+    combined_json = os.path.join(work_dir, COMBINED_JSON)
+    rider_json = os.path.join(work_dir, RIDER_JSON)
+    final_json = os.path.join(work_dir, FINAL_JSON)
 
     try:
+        # Started inside the try so the sampler thread is always stopped in `finally`
+        if profile_mode:
+            profile_session = ProfileSession(profile_mode)
+            print(f"🔬 Profiling request ({profile_session.mode}) → id {profile_session.id}")
+
+        admit(stage_gates, deadline)
+
         # ----------------------------
-        # Step 1: Save uploaded file temporarily
+        # Step 1: Save uploaded files temporarily
         # ----------------------------
-        uploaded_files = []
-        if pdf_file:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(pdf_file.filename)[1]) as tmp:
-                tmp.write(await pdf_file.read())
+        uploaded_files, file_names = [], []
+        for upload in ([pdf_file] if pdf_file else []) + (files or []):
+            if not upload or not upload.filename:
+                continue
+            with tempfile.NamedTemporaryFile(delete=False, dir=work_dir, suffix=os.path.splitext(upload.filename)[1]) as tmp:
+                tmp.write(await upload.read())
                 uploaded_files.append(tmp.name)
+                file_names.append(upload.filename)
 
         # --------------------------------------------------
         # FIX 2: Unpack Complex Symptoms JSON and Restructure form_data
@@ -118,19 +196,26 @@ async def process_pipeline(
         # Step 3: Parser → combined_output.json
         # ----------------------------
         print("🩺 Step 1: Running Parser...")
-        combined_data = run_parser(form_data, uploaded_files, COMBINED_JSON)
+        combined_data = await stage_gates["parser"].run(
+            deadline, stage_func(profile_session, "parser", run_parser), form_data, uploaded_files, combined_json, deadline, file_names,
+            profile_session.wrap if profile_session else None    # profile the extraction pool threads too
+        )
 
         # ----------------------------
         # Step 4: Rider → final_combined_with_rider.json
         # ----------------------------
         print("💊 Step 2: Running Rider...")
-        rider_output = run_rider(COMBINED_JSON)
+        rider_output = await stage_gates["rider"].run(
+            deadline, stage_func(profile_session, "rider", run_rider), combined_json, rider_json
+        )
 
         # ----------------------------
         # Step 5: Gemini → final_output_with_gemini.json
         # ----------------------------
         print("🧠 Step 3: Running Gemini...")
-        gemini_output = run_gemini(RIDER_JSON, FINAL_JSON)
+        gemini_output = await stage_gates["gemini"].run(
+            deadline, stage_func(profile_session, "gemini", run_gemini), rider_json, final_json, deadline
+        )
 
         # ----------------------------
         # Step 6: Combine all results
@@ -141,8 +226,19 @@ async def process_pipeline(
             "gemini_output": gemini_output
         }
 
+        headers = None
+        if profile_session:
+            response["profile_id"] = profile_session.id
+            headers = {"X-Profile-Id": profile_session.id}
+
         print("✅ Pipeline completed successfully.")
-        return JSONResponse(content=response, status_code=200)
+        return JSONResponse(content=response, status_code=200, headers=headers)
+
+    except RequestShed as shed:
+        return shed_response(shed)
+
+    except TimeoutError as e:
+        return shed_response(RequestShed(503, str(e), stage_gates["parser"].retry_after()))
 
     except Exception as e:
         print(f"❌ Pipeline error: {e}")
@@ -153,6 +249,115 @@ async def process_pipeline(
             status_code=500
         )
 
+    finally:
+        if profile_session:
+            profile_store.put(profile_session.finish())
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@app.post("/bp-log")
+async def import_bp_log(
+    request: Request,
+    log_file: UploadFile = File(...),
+    patient_name: str = Form("Unknown"),
+    age: int = Form(None),
+    sex: str = Form(None),
+    current_medications: str = Form("[]")
+):
+    """
+    Home BP log (.csv / .json / .jsonl) → vectorized summary → Rider.
+    The log's average grade is used as the patient's effective hypertension grade.
+    """
+    deadline = getattr(request.state, "deadline", None)
+    work_dir = tempfile.mkdtemp(prefix="bplog_", dir=DATA_DIR)
+    combined_json = os.path.join(work_dir, COMBINED_JSON)
+    rider_json = os.path.join(work_dir, RIDER_JSON)
+
+    try:
+        admit({name: stage_gates[name] for name in ("parser", "rider")}, deadline)
+
+        print("📈 Step 1: Summarizing home BP log...")
+        summary = await stage_gates["parser"].run(deadline, summarize_bp_log, log_file.file, log_file.filename)
+
+        combined = {
+            "patient_name": patient_name,
+            "age": age,
+            "sex": sex,
+            "vitals": {
+                "bp_systolic": round(summary["systolic_mean"]),
+                "bp_diastolic": round(summary["diastolic_mean"]),
+            },
+            "hypertension_grade": summary["effective_grade"],
+            "home_bp_summary": summary,
+            "current_medications": json.loads(current_medications),
+        }
+        with open(combined_json, "w", encoding="utf-8") as f:
+            json.dump(combined, f, indent=2, ensure_ascii=False)
+
+        print("💊 Step 2: Running Rider...")
+        rider_output = await stage_gates["rider"].run(deadline, run_rider, combined_json, rider_json)
+
+        return JSONResponse(content={"home_bp_summary": summary, "rider_output": rider_output}, status_code=200)
+
+    except RequestShed as shed:
+        return shed_response(shed)
+
+    except TimeoutError as e:
+        return shed_response(RequestShed(503, str(e), stage_gates["parser"].retry_after()))
+
+    except ValueError as e:
+        # Unsupported file type, missing columns or no valid readings
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+
+    except Exception as e:
+        print(f"❌ BP log error: {e}")
+        traceback.print_exc()
+        return JSONResponse(
+            content={"error": f"Internal Server Error during BP log import: {str(e)}"},
+            status_code=500
+        )
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@app.get("/debug/profiles")
+def list_profiles(request: Request):
+    """List retained request profiles (admin only)."""
+    if not is_admin(request.headers.get(ADMIN_TOKEN_HEADER)):
+        return JSONResponse(content={"error": "Forbidden"}, status_code=403)
+    return {"profiles": profile_store.list()}
+
+
+@app.get("/debug/profiles/{profile_id}")
+def download_profile(profile_id: str, request: Request, format: str = None):
+    """
+    Download a stored profile (admin only).
+    format: pstats (cprofile default), text, collapsed (sample default)
+    """
+    if not is_admin(request.headers.get(ADMIN_TOKEN_HEADER)):
+        return JSONResponse(content={"error": "Forbidden"}, status_code=403)
+
+    result = profile_store.get(profile_id)
+    if not result:
+        return JSONResponse(content={"error": f"Profile {profile_id} not found or expired"}, status_code=404)
+
+    fmt = format or ("pstats" if result["mode"] == "cprofile" else "collapsed")
+    if fmt not in result:
+        return JSONResponse(content={"error": f"Format '{fmt}' not available for {result['mode']} profiles"}, status_code=400)
+
+    if fmt == "pstats":
+        return Response(
+            content=result["pstats"],
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{profile_id}.pstats"'}
+        )
+    return Response(
+        content=result[fmt],
+        media_type="text/plain",
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.{"txt" if fmt == "text" else "folded"}"'}
+    )
+
 
 # ------------------------------------------------------
 # SERVER ENTRY POINT
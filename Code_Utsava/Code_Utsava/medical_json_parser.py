@@ -1,17 +1,39 @@
 import os
 import re
 import json
+import time
 import hashlib
 import datetime
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 import pdfplumber
 from PIL import Image
 import pytesseract
+from ocr_preprocess import preprocess_for_ocr, preprocess_regions
 
 # -------------------------------
 # CONFIG
 # -------------------------------
 pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 
+# "full" = clean up the whole page, "regions" = only OCR vitals/labs regions, "raw" = no preprocessing
+OCR_MODE = os.getenv("OCR_MODE", "full")
+
+# Shared pool for per-document extraction (tesseract runs as a subprocess, so threads overlap well)
+EXTRACTION_WORKERS = int(os.getenv("PARSER_WORKERS", str(min(8, (os.cpu_count() or 1) + 2))))
+EXTRACTION_POOL = ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS, thread_name_prefix="doc-extract")
+
+# pdfplumber is pure Python and holds the GIL, so threads read PDFs one after another.
+# With several PDFs in a request their text is read in worker processes instead
+# (1 = always read in the extraction thread, e.g. on a single-core host).
+PDF_PROCESSES = int(os.getenv("PARSER_PDF_PROCESSES", str(min(4, os.cpu_count() or 1))))
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg")
+
 
 # -------------------------------
 # HELPERS (Remain the same)
@@ -28,15 +50,47 @@ def read_pdf_text(path: str) -> str:
     except Exception:
         return ""
 
-def ocr_image_text(path: str) -> str:
+def _pdf_process_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn, not fork: the server process is already running threads
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+def read_pdf_text_in_process(path: str, timeout: float = 0) -> str:
+    """read_pdf_text in a worker process, so several PDFs can be parsed in parallel."""
+    global _pdf_pool
+    try:
+        return _pdf_process_pool().submit(read_pdf_text, path).result(timeout=timeout or None)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM on a huge PDF); start a fresh pool next time and read in-thread now
+        with _pdf_pool_lock:
+            _pdf_pool = None
+        return read_pdf_text(path)
+
+def ocr_image_text(path: str, timeout: float = 0, mode: str = None) -> str:
     if not file_exists(path):
         return ""
+    mode = mode or OCR_MODE
     try:
-        img = Image.open(path)
-        return pytesseract.image_to_string(img)
+        # timeout=0 means no limit; otherwise tesseract is killed once it runs out
+        if mode == "regions":
+            return "\n".join(pytesseract.image_to_string(r, timeout=timeout) for r in preprocess_regions(path))
+        img = Image.open(path) if mode == "raw" else preprocess_for_ocr(path)
+        return pytesseract.image_to_string(img, timeout=timeout)
     except Exception:
         return ""
 
+def time_left(deadline) -> float:
+    """Seconds left before the time.monotonic() deadline; raises TimeoutError once it has passed."""
+    if deadline is None:
+        return 0
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise TimeoutError("Request deadline exceeded during parsing")
+    return left
+
 def normalize_text(text: str) -> str:
     if not text:
         return ""
@@ -123,27 +177,166 @@ def extract_pmh(text: str) -> list:
     return []
 
 
+def extract_report_date(text: str):
+    """
+    Report/collection date as an ISO date string, or None.
+    Labelled dates (Report/Reported/Collection/Sample Date) win over a bare 'Date:';
+    birth dates ('Birth Date', 'Date of Birth', 'DOB') are never used.
+    """
+    value = r"[:\s]*(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4})"
+    m = (re.search(r"\b(?:Report(?:ed)?|Collect(?:ion|ed)|Sample)\s+(?:Date|On)" + value, text, re.IGNORECASE)
+         or re.search(r"(?<!Birth )\bDate(?!\s+of\s+Birth)" + value, text, re.IGNORECASE))
+    if not m:
+        return None
+    raw = m.group(1).replace(".", "/").replace("-", "/")
+    for fmt in ("%Y/%m/%d", "%d/%m/%Y", "%d/%m/%y"):
+        try:
+            return datetime.datetime.strptime(raw, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+# -------------------------------
+# PER-DOCUMENT EXTRACTION + MERGE
+# -------------------------------
+def extract_document(path: str, index: int, display_name: str = None, timeout: float = 0,
+                     pdf_in_process: bool = False) -> dict:
+    """Read one file and run every extractor on its text alone."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        text = read_pdf_text_in_process(path, timeout) if pdf_in_process else read_pdf_text(path)
+    elif ext in IMAGE_EXTS:
+        text = ocr_image_text(path, timeout=timeout)
+    else:
+        text = ""
+    text = normalize_text(text)
+    return {
+        "index": index,
+        "file_name": display_name or os.path.basename(path),
+        "source_type": ext.lstrip("."),
+        "report_date": extract_report_date(text),
+        "vitals": extract_vitals(text),
+        "lab_results": extract_labs(text),
+        "current_medications": extract_medications(text),
+        "diagnoses": extract_diagnoses(text),
+        "past_medical_history": extract_pmh(text),
+    }
+
+
+def extract_documents(file_paths: list, file_names: list = None, deadline: float = None, instrument=None) -> list:
+    """
+    Extract every document concurrently (one task per file) in the shared pool.
+    `instrument(name, func)` optionally wraps each task (main.py passes ProfileSession.wrap),
+    since the pool threads are outside the caller's own profiler. PDF text read in a worker
+    process shows up in a profile only as time spent waiting on the result.
+    """
+    file_paths, file_names = file_paths or [], file_names or []
+    budget = time_left(deadline)    # checked once; every task gets the same OCR budget
+    # A lone PDF gains nothing from a worker process, so only hand PDFs off when they'd otherwise queue
+    pdf_count = sum(os.path.splitext(f)[1].lower() == ".pdf" for f in file_paths)
+    pdf_in_process = PDF_PROCESSES > 1 and pdf_count > 1
+    futures = []
+    for i, f in enumerate(file_paths):
+        task = instrument(f"extract_doc{i}", extract_document) if instrument else extract_document
+        futures.append(EXTRACTION_POOL.submit(
+            task, f, i, file_names[i] if i < len(file_names) else None, budget, pdf_in_process
+        ))
+    if not futures:
+        return []
+    done, pending = wait(futures, timeout=time_left(deadline) or None)
+    if pending:
+        for fut in pending:
+            fut.cancel()
+        raise TimeoutError("Request deadline exceeded during parsing")
+    return [fut.result() for fut in futures]
+
+
+_DOSAGE_FORM = re.compile(r"^(?:(?:tab|tablet|tabs|cap|caps|capsule|inj|injection|syp|syrup)\b\.?\s*)+", re.IGNORECASE)
+_DOSE = re.compile(r"\s*\d+(?:\.\d+)?\s*(?:mg|mcg|g|ml|units)\b.*$", re.IGNORECASE)
+
+def drug_key(med: str) -> str:
+    """Normalized drug name: 'Tab Amlodipine 5 mg' → 'amlodipine'."""
+    name = _DOSE.sub("", med.strip())
+    name = _DOSAGE_FORM.sub("", name)
+    return " ".join(name.split()).casefold()
+
+
+def _merge_terms(lists: list) -> list:
+    """Union of term lists (newest first); a more specific term replaces one it contains."""
+    merged = []
+    for terms in lists:
+        for term in terms:
+            low = term.casefold()
+            for i, existing in enumerate(merged):
+                ex_low = existing.casefold()
+                if low in ex_low:
+                    break
+                if ex_low in low:
+                    merged[i] = term
+                    break
+            else:
+                merged.append(term)
+    return merged
+
+
+def merge_documents(docs: list) -> dict:
+    """
+    Merge per-document extractions with deterministic precedence:
+      - documents are ranked by report date, then by upload order (undated sort as oldest)
+      - vitals / labs: each field comes from the most recent document that has it
+      - medications: one entry per drug (dosage form and dose ignored), taken from the most
+        recent document that lists it; entries within a document are never collapsed
+      - diagnoses / history: union, where a more specific term replaces a generic one
+    """
+    newest_first = sorted(docs, key=lambda d: (d["report_date"] or "", d["index"]), reverse=True)
+
+    vitals, labs = {}, {}
+    for d in reversed(newest_first):
+        vitals.update(d["vitals"])
+        labs.update(d["lab_results"])
+
+    # De-duplicate only across documents: a drug already listed by a newer report is skipped,
+    # but everything within one report is kept as-is
+    meds, seen_drugs = [], set()
+    for d in newest_first:
+        doc_drugs = set()
+        for med in d["current_medications"]:
+            drug = drug_key(med)
+            if drug not in seen_drugs:
+                doc_drugs.add(drug)
+                meds.append(med)
+        seen_drugs |= doc_drugs
+
+    return {
+        "vitals": vitals,
+        "lab_results": labs,
+        "current_medications": meds,
+        "diagnoses": _merge_terms([d["diagnoses"] for d in newest_first]),
+        "past_medical_history": _merge_terms([d["past_medical_history"] for d in newest_first]),
+    }
+
+
 # -------------------------------
 # CORE BUILDER LOGIC (Renamed to process_inputs_core)
 # -------------------------------
-def process_inputs_core(form_data: dict, file_paths: list, output_path: str) -> dict:
+def process_inputs_core(form_data: dict, file_paths: list, output_path: str, deadline: float = None,
+                        file_names: list = None, instrument=None) -> dict:
     """
     Core function to combine form data, file data, and generate initial combined JSON.
     NOTE: The form_data received here must be pre-unpacked by main.py.
+    Files are extracted concurrently and merged per patient (see merge_documents).
+    `deadline` is an optional time.monotonic() value; TimeoutError is raised once it passes.
+    `file_names` are the original upload names, reported instead of temp file names.
+    `instrument` is passed through to extract_documents (used for per-request profiling).
     """
-    text_data = []
-    for f in (file_paths or []):
-        ext = os.path.splitext(f)[1].lower()
-        if ext == ".pdf":
-            text_data.append(read_pdf_text(f))
-        elif ext in (".png", ".jpg", ".jpeg"):
-            text_data.append(ocr_image_text(f))
-
-    text = normalize_text("\n".join(text_data))
+    docs = extract_documents(file_paths, file_names, deadline, instrument)
+    merged = merge_documents(docs)
 
     # Vitals: Extract via OCR/Regex, then override/fill with form data
-    vit = extract_vitals(text)
-    vit.update({k: form_data.get(k, vit.get(k)) for k in ["bp_systolic", "bp_diastolic", "pulse_bpm", "temperature_c", "spo2_percent"]})
+    vit = dict(merged["vitals"])
+    vit.update({k: form_data[k] if form_data.get(k) is not None else vit.get(k)
+                for k in ["bp_systolic", "bp_diastolic", "pulse_bpm", "temperature_c", "spo2_percent"]})
     grade = classify_hypertension(vit.get("bp_systolic"), vit.get("bp_diastolic"))
 
     # Medication/History: Prioritize form data that was unpacked by main.py
@@ -153,14 +346,14 @@ def process_inputs_core(form_data: dict, file_paths: list, output_path: str) ->
     if client_med_list and isinstance(client_med_list, list):
         current_meds = [f"{m.get('name', '')} {m.get('dosage', '')}" for m in client_med_list]
     else:
-        current_meds = extract_medications(text)
+        current_meds = merged["current_medications"]
     
     # Past Medical History: Prefer the history string entered by the user
     client_pmh_str = form_data.get("medical_history", "")
     if client_pmh_str:
         past_med_history = [s.strip() for s in re.split(r",|;|\band\b", client_pmh_str) if len(s.strip()) > 2]
     else:
-        past_med_history = extract_pmh(text)
+        past_med_history = merged["past_medical_history"]
         
         
     result = {
@@ -169,18 +362,20 @@ def process_inputs_core(form_data: dict, file_paths: list, output_path: str) ->
         "age": form_data.get("age"),
         "sex": form_data.get("sex"),
         "report_source": {
-            "file_name": os.path.basename(file_paths[0]) if file_paths else None,
-            "source_type": [os.path.splitext(f)[1].lstrip('.') for f in (file_paths or [])] or ["form"],
+            "file_name": docs[0]["file_name"] if docs else None,
+            "source_type": [d["source_type"] for d in docs] or ["form"],
+            "files": [{"file_name": d["file_name"], "source_type": d["source_type"], "report_date": d["report_date"]}
+                      for d in docs],
             "extraction_timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
         },
         "vitals": vit,
         "hypertension_grade": grade,
         # The 'symptoms' field now takes the simple list prepared in main.py
         "symptoms": form_data.get("symptoms", []), 
-        "diagnoses": extract_diagnoses(text),
+        "diagnoses": merged["diagnoses"],
         "past_medical_history": past_med_history,
         "current_medications": current_meds,
-        "lab_results": extract_labs(text),
+        "lab_results": merged["lab_results"],
         "parser_metadata": {
             "parser_version": "v4.1.1",
             "ocr_engine": "tesseract-5.4.0",
@@ -198,7 +393,74 @@ def process_inputs_core(form_data: dict, file_paths: list, output_path: str) ->
 # ------------------------------------------------------
 # 🟢 CORRECTED WRAPPER for FastAPI
 # ------------------------------------------------------
-def process_inputs(form_data: dict, file_paths: list, output_path: str):
+def process_inputs(form_data: dict, file_paths: list, output_path: str, deadline: float = None,
+                   file_names: list = None, instrument=None):
     """Wrapper used by main.py to call the core logic."""
     # The fix is calling the renamed core function:
-    return process_inputs_core(form_data, file_paths, output_path)
\ No newline at end of file
+    return process_inputs_core(form_data, file_paths, output_path, deadline, file_names, instrument)
+
+
+# ------------------------------------------------------
+# BENCHMARK: N documents vs the slowest one alone
+# ------------------------------------------------------
+def _write_text_pdf(path: str, lines: list):
+    """Minimal single-font text PDF (no extra dependencies); one page per 60 lines."""
+    pages = [lines[i:i + 60] for i in range(0, len(lines), 60)] or [[]]
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page_lines in pages:
+        body = "BT /F1 9 Tf 40 800 Td 11 TL " + " ".join(
+            "({}) '".format(l.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")) for l in page_lines
+        ) + " ET"
+        objects.append(f"<< /Length {len(body)} >>\nstream\n{body}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    out, offsets = "%PDF-1.4\n", []
+    for n, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n{obj}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    with open(path, "w", encoding="latin-1") as f:
+        f.write(out)
+
+def run_benchmark(page_counts=(12, 8, 6, 4)):
+    global PDF_PROCESSES
+    import tempfile
+    report = ["Report Date: 2024-03-01", "BP: 148/94 mmHg Pulse: 84", "Total Cholesterol: 232 mg/dL",
+              "Tab Amlodipine 5 mg", "Diagnosis: Hypertension"]
+    filler = "Observation {}: findings within the expected range for the reviewed parameter set."
+    work = tempfile.mkdtemp(prefix="parser_bench_")
+    paths = []
+    for i, pages in enumerate(page_counts):
+        path = os.path.join(work, f"report_{i}.pdf")
+        _write_text_pdf(path, report + [filler.format(n) for n in range(pages * 60 - len(report))])
+        paths.append(path)
+
+    print(f"📊 Parser benchmark: {len(paths)} PDFs ({', '.join(map(str, page_counts))} pages), "
+          f"{os.cpu_count()} CPU(s)")
+    singles = []
+    for path in paths:
+        started = time.perf_counter()
+        extract_document(path, 0)
+        singles.append(time.perf_counter() - started)
+    print(f"   slowest single doc      {max(singles):6.2f} s   (sum of all {sum(singles):.2f} s)")
+
+    configured = PDF_PROCESSES
+    for label, procs in (("thread pool", 1), ("process pool", max(2, configured))):
+        PDF_PROCESSES = procs
+        extract_documents(paths)        # warm-up (spawns the worker processes once)
+        started = time.perf_counter()
+        extract_documents(paths)
+        elapsed = time.perf_counter() - started
+        print(f"   all docs, {label:<13} {elapsed:6.2f} s   ({elapsed / max(singles):.2f}x slowest)")
+    PDF_PROCESSES = configured
+
+
+if __name__ == "__main__":
+    run_benchmark()
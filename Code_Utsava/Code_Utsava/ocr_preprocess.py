@@ -0,0 +1,272 @@
+"""
+ocr_preprocess.py — Image Cleanup Before Tesseract (phone photos of reports)
+
+Pipeline:
+    open (JPEG draft decode) → EXIF rotation → grayscale → downscale to target DPI
+    → deskew → crop to page → adaptive binarization → despeckle
+    → crop to text, or [regions mode] page-relative vitals/labs boxes each cropped to text
+
+Everything after decoding works on NumPy arrays so a 12 MP photo is reduced to a
+small, clean, black-on-white page before tesseract ever sees it.
+
+Run directly for a benchmark on a synthetic photo corpus:
+    python ocr_preprocess.py
+"""
+
+import os
+import time
+import numpy as np
+from PIL import Image, ImageOps
+
+# -----------------------------
+# CONFIG
+# -----------------------------
+TARGET_DPI = int(os.getenv("OCR_TARGET_DPI", "300"))
+PAGE_LONG_SIDE_IN = 11.69          # A4; phone photos are assumed to frame one page
+BINARIZE_WINDOW = 31               # px, local mean window (odd)
+BINARIZE_OFFSET = 12               # grey levels below local mean that count as ink
+DESKEW_MAX_ANGLE = 10.0            # degrees
+DESKEW_STEP = 0.5
+DESKEW_WORK_SIDE = 800             # deskew angle is searched on a thumbnail this size
+CROP_MARGIN = 20                   # px kept around detected text
+CROP_MIN_INK = 0.002               # row/col ink fraction (after despeckle) that counts as text
+PAGE_MIN_FILL = 0.5                # row/col share of bright pixels that counts as page
+PAGE_INSET = 0.03                  # fraction trimmed inside the page box to drop its edge lines
+
+# Fractional (left, top, right, bottom) boxes of the *page* (not the photo) where vitals
+# and lab panels usually appear on the reports we receive.
+REGIONS = {
+    "vitals": (0.0, 0.0, 1.0, 0.18),
+    "labs": (0.0, 0.18, 1.0, 0.45),
+}
+
+
+# -----------------------------
+# STAGES
+# -----------------------------
+def load_image(path: str, target_dpi: int = TARGET_DPI) -> Image.Image:
+    """Open with JPEG draft decoding (DCT-domain downscale) and apply EXIF rotation."""
+    img = Image.open(path)
+    target = int(PAGE_LONG_SIDE_IN * target_dpi)
+    scale = target / max(img.size)
+    if scale < 1:
+        # draft() only picks a power-of-two reduction that stays >= the requested size
+        img.draft("L", (int(img.size[0] * scale), int(img.size[1] * scale)))
+    return ImageOps.exif_transpose(img)
+
+def to_grayscale(img: Image.Image) -> Image.Image:
+    return img if img.mode == "L" else img.convert("L")
+
+def downscale(img: Image.Image, target_dpi: int = TARGET_DPI) -> Image.Image:
+    target = int(PAGE_LONG_SIDE_IN * target_dpi)
+    long_side = max(img.size)
+    if long_side <= target:
+        return img
+    scale = target / long_side
+    return img.resize((round(img.size[0] * scale), round(img.size[1] * scale)), Image.Resampling.LANCZOS)
+
+def estimate_skew(gray: np.ndarray) -> float:
+    """Angle (degrees) that maximises the variance of the horizontal ink projection."""
+    thumb = Image.fromarray(gray)
+    thumb.thumbnail((DESKEW_WORK_SIDE, DESKEW_WORK_SIDE))
+    # Local threshold so uneven lighting doesn't show up as a block of "ink"
+    mask = 255 - adaptive_binarize(np.asarray(thumb), window=15)
+    # Rows/cols that are mostly "ink" are page edges against a dark background, not text
+    mask[(mask > 0).mean(axis=1) > 0.5, :] = 0
+    mask[:, (mask > 0).mean(axis=0) > 0.5] = 0
+    if not mask.any():
+        return 0.0
+    ink = Image.fromarray(mask)
+
+    def score(angle: float) -> float:
+        rotated = np.asarray(ink.rotate(angle, resample=Image.Resampling.NEAREST, fillcolor=0))
+        return float(np.var(rotated.sum(axis=1, dtype=np.float64)))
+
+    # Start from "no rotation" so a flat profile (blank or near-blank page) is left alone
+    best_angle, best_score = 0.0, score(0.0)
+    for angle in np.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + DESKEW_STEP, DESKEW_STEP):
+        angle_score = score(float(angle))
+        if angle_score > best_score:
+            best_angle, best_score = float(angle), angle_score
+    return best_angle
+
+def deskew(img: Image.Image) -> Image.Image:
+    gray = np.asarray(img)
+    angle = estimate_skew(gray)
+    if abs(angle) < DESKEW_STEP / 2:
+        return img
+    # Fill exposed corners with the frame's border tone (background, or paper if the page fills the shot)
+    border = np.concatenate([gray[0], gray[-1], gray[:, 0], gray[:, -1]])
+    return img.rotate(angle, resample=Image.Resampling.BILINEAR, expand=True, fillcolor=int(np.median(border)))
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    hist = np.bincount(gray[::4, ::4].ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * levels)
+    mean0 = m0 / np.maximum(w0, 1)
+    mean1 = (m0[-1] - m0) / np.maximum(w1, 1)
+    return int(np.argmax(w0 * w1 * (mean0 - mean1) ** 2))
+
+def crop_to_page(gray: np.ndarray) -> np.ndarray:
+    """Bounding box of the bright document against a darker background (whole frame if none)."""
+    paper = gray > otsu_threshold(gray)
+    rows = np.flatnonzero(paper.mean(axis=1) > PAGE_MIN_FILL)
+    cols = np.flatnonzero(paper.mean(axis=0) > PAGE_MIN_FILL)
+    if rows.size == 0 or cols.size == 0:
+        return gray
+    dy, dx = int(PAGE_INSET * gray.shape[0]), int(PAGE_INSET * gray.shape[1])
+    top, bottom = rows[0] + dy, rows[-1] + 1 - dy
+    left, right = cols[0] + dx, cols[-1] + 1 - dx
+    if bottom <= top or right <= left:
+        return gray
+    return gray[top:bottom, left:right]
+
+def adaptive_binarize(gray: np.ndarray, window: int = BINARIZE_WINDOW, offset: int = BINARIZE_OFFSET) -> np.ndarray:
+    """Local-mean threshold via an integral image; returns uint8 (0 = ink, 255 = paper)."""
+    r = window // 2
+    g = gray.astype(np.float64)
+    padded = np.pad(g, r, mode="edge")
+    ii = np.pad(padded, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    w = 2 * r + 1
+    local_sum = ii[w:, w:] - ii[:-w, w:] - ii[w:, :-w] + ii[:-w, :-w]
+    local_mean = local_sum / (w * w)
+    return np.where(g < local_mean - offset, 0, 255).astype(np.uint8)
+
+def despeckle(binary: np.ndarray) -> np.ndarray:
+    """3x3 median (majority vote) on the ink mask; removes salt noise left by binarization."""
+    ink = np.pad((binary == 0).astype(np.uint8), 1)
+    h, w = binary.shape
+    votes = sum(ink[dy:dy + h, dx:dx + w] for dy in range(3) for dx in range(3))
+    return np.where(votes >= 5, 0, 255).astype(np.uint8)
+
+def crop_to_text(binary: np.ndarray, margin: int = CROP_MARGIN) -> np.ndarray:
+    ink = binary == 0
+    # Ignore slivers of page edge hugging the frame border
+    by, bx = max(1, binary.shape[0] // 100), max(1, binary.shape[1] // 100)
+    ink[:by], ink[-by:], ink[:, :bx], ink[:, -bx:] = False, False, False, False
+    rows = np.flatnonzero(ink.mean(axis=1) > CROP_MIN_INK)
+    cols = np.flatnonzero(ink.mean(axis=0) > CROP_MIN_INK)
+    if rows.size == 0 or cols.size == 0:
+        return binary
+    top, bottom = max(rows[0] - margin, 0), min(rows[-1] + margin + 1, binary.shape[0])
+    left, right = max(cols[0] - margin, 0), min(cols[-1] + margin + 1, binary.shape[1])
+    return binary[top:bottom, left:right]
+
+def region_crops(page: np.ndarray, regions: dict = None) -> dict:
+    """Slice the page into the configured fractional regions."""
+    h, w = page.shape[:2]
+    out = {}
+    for name, (l, t, r, b) in (regions or REGIONS).items():
+        out[name] = page[int(t * h):int(b * h), int(l * w):int(r * w)]
+    return out
+
+
+# -----------------------------
+# PUBLIC ENTRY POINTS
+# -----------------------------
+def clean_page(path: str) -> np.ndarray:
+    """Deskewed, page-cropped, binarized and despeckled document (uint8, 0 = ink)."""
+    img = load_image(path)
+    img = deskew(downscale(to_grayscale(img)))
+    page = crop_to_page(np.asarray(img))
+    return despeckle(adaptive_binarize(page))
+
+def preprocess_for_ocr(path: str, crop: bool = True) -> Image.Image:
+    """Full cleanup pipeline; returns a binarized 'L' image ready for tesseract."""
+    page = clean_page(path)
+    if crop:
+        page = crop_to_text(page)
+    return Image.fromarray(page)
+
+def preprocess_regions(path: str, regions: dict = None) -> list:
+    """Cleaned page cut down to the vitals/labs regions only (boxes are relative to the page)."""
+    page = clean_page(path)
+    crops = [crop_to_text(c) for c in region_crops(page, regions).values() if c.size]
+    return [Image.fromarray(c) for c in crops if (c == 0).any()]
+
+
+# -----------------------------
+# BENCHMARK (synthetic phone photos)
+# -----------------------------
+SAMPLE_REPORT = [
+    "CITY DIAGNOSTIC LABORATORY",
+    "Patient: Test Patient   Age: 54   Sex: M",
+    "BP: 152/96   Pulse: 88   SpO2: 97   Temp: 37.1",
+    "Diagnosis: Hypertension, Dyslipidemia",
+    "",
+    "LIPID PROFILE",
+    "Total Cholesterol: 236",
+    "HDL: 38",
+    "LDL: 162",
+    "Triglycerides: 210",
+    "Fasting Glucose: 118",
+    "",
+    "Amlodipine 5 mg once daily",
+    "Telmisartan 40 mg once daily",
+    "",
+    "Signature ______________________",
+]
+
+def make_synthetic_photo(path: str, angle: float, seed: int):
+    """Render SAMPLE_REPORT as a tilted, shaded, noisy 12 MP colour 'photo'."""
+    from PIL import ImageDraw, ImageFont
+    rng = np.random.default_rng(seed)
+    page = Image.new("L", (2480, 3508), 255)
+    draw = ImageDraw.Draw(page)
+    font = ImageFont.load_default(size=64)
+    y = 200
+    for line in SAMPLE_REPORT:
+        draw.text((180, y), line, fill=20, font=font)
+        y += 110
+    page = page.rotate(angle, resample=Image.Resampling.BILINEAR, expand=True, fillcolor=255)
+
+    # Place on a dark 3000x4000 background with an illumination gradient and sensor noise
+    page = page.resize((2700, int(2700 * page.size[1] / page.size[0])))
+    photo = Image.new("L", (3000, 4000), 60)
+    photo.paste(page.crop((0, 0, 2700, 3850)), (150, 75))
+    arr = np.asarray(photo, dtype=np.float32)
+    gradient = np.linspace(0.75, 1.0, arr.shape[1], dtype=np.float32)[None, :]
+    arr = np.clip(arr * gradient + rng.normal(0, 8, arr.shape), 0, 255).astype(np.uint8)
+    rgb = np.stack([arr, (arr * 0.97).astype(np.uint8), (arr * 0.92).astype(np.uint8)], axis=-1)
+    Image.fromarray(rgb, "RGB").save(path, quality=90)
+
+def _field_accuracy(text: str) -> float:
+    from medical_json_parser import extract_vitals, extract_labs
+    expected = {
+        "bp_systolic": 152, "bp_diastolic": 96, "pulse_bpm": 88, "spo2_percent": 97,
+        "total_cholesterol_mgdl": 236, "hdl_mgdl": 38, "ldl_mgdl": 162,
+        "triglycerides_mgdl": 210, "fasting_glucose_mgdl": 118,
+    }
+    found = {**extract_vitals(text), **extract_labs(text)}
+    return sum(1 for k, v in expected.items() if found.get(k) == v) / len(expected)
+
+def run_benchmark(n: int = 6):
+    import tempfile
+    import pytesseract
+    import medical_json_parser     # noqa: F401 — imported first: it sets the Windows tesseract path
+    pytesseract.pytesseract.tesseract_cmd = os.getenv("TESSERACT_CMD", "tesseract")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(n):
+            p = os.path.join(tmp, f"photo_{i}.jpg")
+            make_synthetic_photo(p, angle=(-6 + 12 * i / max(1, n - 1)), seed=i)
+            paths.append(p)
+
+        modes = {
+            "raw": lambda p: pytesseract.image_to_string(Image.open(p)),
+            "preprocessed": lambda p: pytesseract.image_to_string(preprocess_for_ocr(p)),
+            "regions": lambda p: "\n".join(pytesseract.image_to_string(r) for r in preprocess_regions(p)),
+        }
+        print(f"📊 OCR benchmark on {n} synthetic phone photos")
+        for name, fn in modes.items():
+            started = time.perf_counter()
+            acc = [_field_accuracy(fn(p)) for p in paths]
+            elapsed = time.perf_counter() - started
+            print(f"   {name:<13} {elapsed / n:6.2f} s/photo   field accuracy {np.mean(acc):.0%}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
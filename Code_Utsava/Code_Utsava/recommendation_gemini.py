@@ -17,7 +17,9 @@ Output:
 
 import os
 import json
+import time
 from google import genai
+from google.genai import types
 
 # -----------------------------
 # CONFIG
@@ -93,16 +95,24 @@ def detect_bp_alert(vitals: dict) -> dict:
 # -----------------------------
 # MAIN FUNCTION
 # -----------------------------
-def main():
+def main(input_file=None, output_file=None, deadline=None):
     print("🚀 Generating Overall Health & Lifestyle Recommendations...\n")
+    input_file = input_file or INPUT_FILE
+    output_file = output_file or OUTPUT_FILE
 
     # 1️⃣ Load combined data
-    combined = load_json(INPUT_FILE)
-    print(f"✅ Loaded file: {INPUT_FILE}")
+    combined = load_json(input_file)
+    print(f"✅ Loaded file: {input_file}")
 
-    # 2️⃣ Initialize Gemini
+    # 2️⃣ Initialize Gemini (HTTP timeout bounded by the request deadline, if any)
     api_key = get_api_key()
-    client = genai.Client(api_key=api_key)
+    http_options = None
+    if deadline is not None:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise TimeoutError("Request deadline exceeded before Gemini call")
+        http_options = types.HttpOptions(timeout=int(left * 1000))
+    client = genai.Client(api_key=api_key, http_options=http_options)
     print("✅ Gemini client initialized.\n")
 
     # 3️⃣ Detect BP Alert
@@ -146,20 +156,25 @@ Rules:
         print("✅ Gemini model response received.\n")
     except Exception as e:
         print(f"❌ Gemini API call failed: {e}")
-        return
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError("Request deadline exceeded during Gemini call") from e
+        result_text = None
+        # Still write the output (with the error) so callers always get a result file
+        overall = {"error": f"Gemini recommendations unavailable: {e}"}
 
     # 6️⃣ Parse Gemini output cleanly
-    try:
-        cleaned_text = (
-            result_text.replace("```json", "")
-            .replace("```", "")
-            .strip()
-        )
-        gemini_output = json.loads(cleaned_text)
-        overall = gemini_output.get("Overall Recommendations", {})
-    except json.JSONDecodeError:
-        print("⚠️ Model did not return valid JSON, saving raw output.")
-        overall = {"text_output": result_text}
+    if result_text is not None:
+        try:
+            cleaned_text = (
+                result_text.replace("```json", "")
+                .replace("```", "")
+                .strip()
+            )
+            gemini_output = json.loads(cleaned_text)
+            overall = gemini_output.get("Overall Recommendations", {})
+        except json.JSONDecodeError:
+            print("⚠️ Model did not return valid JSON, saving raw output.")
+            overall = {"text_output": result_text}
 
     # 7️⃣ Add BP Alert (if any)
     if alert_data:
@@ -167,11 +182,12 @@ Rules:
 
     # 8️⃣ Merge and Save
     combined["Overall Recommendations"] = overall
-    save_json(OUTPUT_FILE, combined)
-    print(f"✅ Final output saved to: {OUTPUT_FILE}\n")
+    save_json(output_file, combined)
+    print(f"✅ Final output saved to: {output_file}\n")
 
     print("🎯 Overall Recommendations:")
     print(json.dumps(overall, indent=2))
+    return combined
 
 # -----------------------------
 # RUN
@@ -180,12 +196,9 @@ if __name__ == "__main__":
     main()
 
 # -------------- WRAPPER for FastAPI -----------------
-def generate_gemini_recommendation(input_path: str, output_path: str):
+def generate_gemini_recommendation(input_path: str, output_path: str, deadline: float = None):
     """Wrapper for FastAPI to use Gemini recommender dynamically"""
-    global INPUT_FILE, OUTPUT_FILE
-    INPUT_FILE = input_path
-    OUTPUT_FILE = output_path
-    main()
+    main(input_path, output_path, deadline)
     with open(output_path, "r", encoding="utf-8") as f:
         return json.load(f)
 
@@ -0,0 +1,234 @@
+"""
+request_profiler.py — On-Demand Profiling of a Single /process Request
+
+An admin sends `X-Profile: cprofile|sample` (or `?profile=...`) together with
+`X-Admin-Token`, and main.py wraps the parser, rider and Gemini stages of that one
+request in a ProfileSession:
+
+    cprofile → deterministic cProfile, downloadable as .pstats (or a text summary)
+    sample   → wall-clock stack sampler, downloadable as collapsed stacks (flamegraph.pl / speedscope)
+
+Results live in a small in-memory ProfileStore and are served from /debug/profiles/{id}.
+Only one request at a time can hold cProfile; a concurrent cprofile request still gets
+stage times plus a `note`. On Python 3.12+ that one profiler is process-wide, so it
+also records whatever other requests run while a profiled stage is in flight.
+Requests without the flag never touch this module, so they pay no profiling overhead.
+"""
+
+import io
+import os
+import sys
+import time
+import hmac
+import uuid
+import marshal
+import pstats
+import cProfile
+import threading
+from collections import Counter, OrderedDict
+
+# -----------------------------
+# CONFIG
+# -----------------------------
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_HEADER = "X-Profile"
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+PROFILE_MODES = ("cprofile", "sample")
+SAMPLE_INTERVAL_S = 0.005
+MAX_STORED_PROFILES = int(os.getenv("PROFILE_MAX_STORED", "20"))
+PROFILE_TTL_S = int(os.getenv("PROFILE_TTL_S", "3600"))
+
+# From 3.12 cProfile sits on sys.monitoring: only one profiler may be active in the whole
+# process, and it sees every thread. Before 3.12 its hooks are per-thread.
+CPROFILE_PROCESS_WIDE = sys.version_info >= (3, 12)
+# Held by the one session currently using cProfile; concurrent cprofile requests only get stage times
+_cprofile_lock = threading.Lock()
+
+
+def is_admin(token) -> bool:
+    # Profiling is disabled entirely unless ADMIN_TOKEN is configured; constant-time compare
+    return bool(ADMIN_TOKEN) and hmac.compare_digest((token or "").encode(), ADMIN_TOKEN.encode())
+
+
+# -----------------------------
+# SAMPLING PROFILER
+# -----------------------------
+class StackSampler:
+    """Samples the stacks of registered threads every SAMPLE_INTERVAL_S seconds."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL_S):
+        self.interval = interval
+        self.counts = Counter()
+        self._threads = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def watch(self, ident: int):
+        self._threads.add(ident)
+
+    def unwatch(self, ident: int):
+        self._threads.discard(ident)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in list(self._threads):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.counts[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.counts.most_common())
+
+
+# -----------------------------
+# PER-REQUEST SESSION
+# -----------------------------
+class ProfileSession:
+    def __init__(self, mode: str):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}', expected one of {PROFILE_MODES}")
+        self.id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.started = time.time()
+        self.stage_times = {}
+        self.note = None
+        self._profiles = []
+        self._sampler = StackSampler() if mode == "sample" else None
+        if self._sampler:
+            self._sampler.start()
+
+        self._owns_cprofile = False
+        self._profiler = None       # process-wide profiler (3.12+)
+        self._depth = 0             # wrapped calls in flight; the outermost one enables the profiler
+        self._depth_lock = threading.Lock()
+        if mode == "cprofile":
+            self._owns_cprofile = _cprofile_lock.acquire(blocking=False)
+            if not self._owns_cprofile:
+                self.note = "cProfile busy with another request; only stage times recorded"
+
+    def wrap(self, stage: str, func):
+        """Return `func` instrumented to run under this session in whichever thread calls it."""
+        def profiled(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                if self._sampler:
+                    ident = threading.get_ident()
+                    self._sampler.watch(ident)
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        self._sampler.unwatch(ident)
+                if not self._owns_cprofile:
+                    return func(*args, **kwargs)
+                if CPROFILE_PROCESS_WIDE:
+                    return self._run_process_wide(func, *args, **kwargs)
+                # Per-thread hooks: each wrapped call (stage or pool task) gets its own profiler
+                prof = cProfile.Profile()
+                try:
+                    return prof.runcall(func, *args, **kwargs)
+                finally:
+                    self._profiles.append(prof)
+            finally:
+                self.stage_times[stage] = time.perf_counter() - started
+        return profiled
+
+    def _run_process_wide(self, func, *args, **kwargs):
+        # Nested calls (pool tasks started by a profiled stage) are already covered by the outer profiler
+        with self._depth_lock:
+            self._depth += 1
+            if self._depth == 1 and self.note is None:
+                if self._profiler is None:
+                    self._profiler = cProfile.Profile()
+                try:
+                    self._profiler.enable()
+                except ValueError as e:     # another sys.monitoring tool (debugger, coverage) is active
+                    self.note = f"cProfile unavailable: {e}"
+                else:
+                    if not self._profiles:
+                        self._profiles.append(self._profiler)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._depth_lock:
+                self._depth -= 1
+                if self._depth == 0 and self.note is None:
+                    self._profiler.disable()
+
+    def finish(self) -> dict:
+        """Stop profiling and return the stored artefacts."""
+        result = {
+            "id": self.id,
+            "mode": self.mode,
+            "created": self.started,
+            "stage_times_s": self.stage_times,
+        }
+        if self.note:
+            result["note"] = self.note
+        if self._owns_cprofile:
+            _cprofile_lock.release()
+            self._owns_cprofile = False
+        if self._sampler:
+            self._sampler.stop()
+            result["collapsed"] = self._sampler.collapsed()
+        elif self._profiles:
+            stats = pstats.Stats(self._profiles[0])
+            for prof in self._profiles[1:]:
+                stats.add(prof)
+            result["pstats"] = marshal.dumps(stats.stats)    # same format as Stats.dump_stats()
+            buf = io.StringIO()
+            stats.stream = buf
+            stats.sort_stats("cumulative").print_stats(50)
+            result["text"] = buf.getvalue()
+        return result
+
+
+# -----------------------------
+# BOUNDED STORE
+# -----------------------------
+class ProfileStore:
+    """Keeps the newest MAX_STORED_PROFILES results for at most PROFILE_TTL_S seconds."""
+
+    def __init__(self, max_items: int = MAX_STORED_PROFILES, ttl: int = PROFILE_TTL_S):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, result: dict):
+        with self._lock:
+            self._items[result["id"]] = result
+            self._expire()
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def get(self, profile_id: str):
+        with self._lock:
+            self._expire()
+            return self._items.get(profile_id)
+
+    def list(self) -> list:
+        with self._lock:
+            self._expire()
+            return [
+                {"id": r["id"], "mode": r["mode"], "created": r["created"], "stage_times_s": r["stage_times_s"],
+                 "note": r.get("note")}
+                for r in self._items.values()
+            ]
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        while self._items and next(iter(self._items.values()))["created"] < cutoff:
+            self._items.popitem(last=False)
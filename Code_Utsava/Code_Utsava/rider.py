@@ -175,16 +175,24 @@ def find_hypertension_plan(grade, tags, htn_map):
 # -----------------------------
 # MAIN EXECUTION
 # -----------------------------
-def merge_medicinal_recommendations():
+def merge_medicinal_recommendations(combined_path=None, output_path=None):
     print("🚀 Generating Medicinal Recommendations...")
+    combined_path = combined_path or COMBINED_PATH
+    output_path = output_path or OUTPUT_PATH
 
-    combined = load_json(COMBINED_PATH)
+    combined = load_json(combined_path)
     brand_map = load_json(BRAND_MAP_PATH)
     htn_map = load_json(HTN_RULE_MAP_PATH)
 
     vitals = combined.get("vitals", {})
-    grade = detect_hypertension_stage(vitals)
-    print(f"🩺 Detected Hypertension Grade: {grade.upper()}")
+    # A home BP log (see bp_log.py) outweighs a single clinic reading
+    home_bp = combined.get("home_bp_summary") or {}
+    if home_bp.get("effective_grade"):
+        grade = home_bp["effective_grade"]
+        print(f"🩺 Hypertension Grade from home BP log ({home_bp.get('reading_count')} readings): {grade.upper()}")
+    else:
+        grade = detect_hypertension_stage(vitals)
+        print(f"🩺 Detected Hypertension Grade: {grade.upper()}")
 
     med_list = combined.get("current_medications", [])
     brands = extract_brand_names(med_list)
@@ -200,9 +208,10 @@ def merge_medicinal_recommendations():
         "Adverse Effects": plan["Adverse Effects"]
     }
 
-    save_json(OUTPUT_PATH, combined)
-    print(f"✅ Saved final output → {OUTPUT_PATH}\n")
+    save_json(output_path, combined)
+    print(f"✅ Saved final output → {output_path}\n")
     print(json.dumps(combined["medicinal_recommendations"], indent=2))
+    return combined
 
 # -----------------------------
 # RUN
@@ -211,10 +220,10 @@ if __name__ == "__main__":
     merge_medicinal_recommendations()
 
 # -------------- WRAPPER for FastAPI -----------------
-def generate_final_recommendation(input_path: str):
+def generate_final_recommendation(input_path: str, output_path: str = None):
     """Wrapper to match main.py interface"""
-    global COMBINED_PATH
-    COMBINED_PATH = input_path
-    merge_medicinal_recommendations()
-    with open(OUTPUT_PATH, "r", encoding="utf-8") as f:
+    # Paths are passed through rather than patched into globals so concurrent requests don't collide
+    output_path = output_path or OUTPUT_PATH
+    merge_medicinal_recommendations(input_path, output_path)
+    with open(output_path, "r", encoding="utf-8") as f:
         return json.load(f)
\ No newline at end of file